@@ -9,11 +9,16 @@ import sys
 import argparse
 import os
 import re
-from typing import List, Set, Tuple, Optional
+from typing import Dict, Iterator, List, Set, Tuple, Optional
 from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 
 
-@dataclass
+# slots=True (без __dict__ у каждого коммита) поддерживается с Python 3.10
+_DATACLASS_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_DATACLASS_SLOTS)
 class GitCommit:
     """Информация о коммите."""
     hash: str
@@ -27,6 +32,14 @@ class GitCommit:
 class GitClient:
     def __init__(self, verbose: bool = False):
         self.verbose = verbose
+        # Постоянный процесс `git cat-file --batch` (запускается при первом запросе)
+        self._batch: Optional[subprocess.Popen] = None
+        # Текущая ветка: запрашивается у git один раз, дальше обновляется в checkout
+        self._current_branch: Optional[str] = None
+        # Конфликтные файлы текущего конфликта (сбрасывается reset_unmerged_files)
+        self._unmerged_files: Optional[List[str]] = None
+        # Pager для команд git, определяется один раз (см. pager)
+        self._pagers: Dict[str, Optional[str]] = {}
 
     def run(self, cmd: List[str], check: bool = True) -> str:
         """Выполняет команду git."""
@@ -35,80 +48,206 @@ class GitClient:
         result = subprocess.run(cmd, capture_output=True, text=True, check=check)
         return result.stdout.strip()
 
+    def run_stream(self, cmd: List[str]) -> subprocess.Popen:
+        """Запускает команду git и отдаёт процесс для построчного чтения stdout."""
+        if self.verbose:
+            print(f" > {' '.join(cmd)}")
+        return subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1
+        )
+
+    def close(self) -> None:
+        """Завершает постоянный процесс git cat-file."""
+        if self._batch is None:
+            return
+        batch, self._batch = self._batch, None
+        try:
+            batch.stdin.close()
+        except OSError:
+            pass
+        batch.wait()
+        batch.stdout.close()
+
+    def __del__(self):
+        self.close()
+
+    def _read_object(self, hash: str) -> Optional[bytes]:
+        """Читает содержимое коммита через постоянный `git cat-file --batch`."""
+        if self._batch is None:
+            cmd = ['git', 'cat-file', '--batch']
+            if self.verbose:
+                print(f" > {' '.join(cmd)}")
+            self._batch = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        self._batch.stdin.write(hash.encode() + b'\n')
+        self._batch.stdin.flush()
+        # Ответ: "<хеш> <тип> <размер>\n<содержимое>\n" или "<хеш> missing\n"
+        header = self._batch.stdout.readline().split()
+        if len(header) != 3:
+            return None
+        data = self._batch.stdout.read(int(header[2]) + 1)[:-1]
+        return data if header[1] == b'commit' else None
+
+    def existing_commits(self, hashes: List[str]) -> Set[str]:
+        """Возвращает хеши, которые существуют и являются коммитами (один вызов cat-file)."""
+        if not hashes:
+            return set()
+        cmd = ['git', 'cat-file', '--batch-check=%(objecttype)']
+        if self.verbose:
+            print(f" > {' '.join(cmd)}")
+        result = subprocess.run(
+            cmd,
+            input=''.join(h + '\n' for h in hashes),
+            capture_output=True,
+            text=True
+        )
+        # Одна строка ответа на каждый хеш: тип объекта или "<хеш> missing"
+        kinds = result.stdout.splitlines()
+        # Сбой git нельзя принимать за «объекта нет»: иначе пропустятся все коммиты
+        if result.returncode != 0 or len(kinds) != len(hashes):
+            raise subprocess.CalledProcessError(
+                returncode=result.returncode,
+                cmd=cmd,
+                output=result.stdout,
+                stderr=result.stderr
+            )
+        return {h for h, kind in zip(hashes, kinds) if kind == 'commit'}
+
     def get_commits_by_tasks(self, branch: str, tasks: Set[str]) -> List[GitCommit]:
-        """Получает коммиты из branch по задачам, в хронологическом порядке."""
+        """
+        Получает коммиты из branch по задачам в порядке применения: топологическом
+        (родители раньше потомков), при равенстве — по дате автора, старые → новые.
+        """
+        return list(self.iter_commits_by_tasks(branch, tasks))
+
+    def iter_commits_by_tasks(self, branch: str, tasks: Set[str]) -> Iterator[GitCommit]:
+        """Потоково отдаёт коммиты из branch по задачам по мере вывода git rev-list."""
         if not tasks:
-            return []
-
-        # Формат: хеш|тема|автор|дата-iso|родители|timestamp
-        log_format = "%H|%s|%an|%ad|%P|%at"
-        log_cmd = [
-            'git', 'log', branch,
-            '--format=' + log_format,
-            '--date=iso',
-            '--no-merges'  # Исключаем merge-коммиты на уровне git log
-        ]
+            return
 
-        # Добавляем grep-фильтры для каждой задачи
-        for task in tasks:
-            log_cmd.extend(['--grep', task])
+        # rev-list отдаёт только хеши без форматирования,
+        # метаданные читаются через cat-file --batch
+        rev_list_cmd = [
+            'git', 'rev-list', branch,
+            '--no-merges',  # Исключаем merge-коммиты на уровне git
+            # Порядок задаёт git (НЕ ПО ЗАДАЧАМ!): топологический, старые → новые.
+            # Дата автора лишь разрешает равенство: коммит с более старой датой
+            # поверх истории (например, после rebase) идёт после своих родителей
+            '--author-date-order', '--reverse',
+            # Один grep-шаблон на все задачи: git компилирует одно регулярное
+            # выражение вместо отдельного --grep на каждую задачу
+            '-E', '--grep', self._tasks_pattern(tasks),
+        ]
 
-        output = self.run(log_cmd, check=False)
-        return self._parse_commits(output, tasks)
+        # --grep ищет по всему сообщению, а задача должна быть в теме коммита
+        subject_re = self._subject_tasks_re(tasks)
 
-    def _parse_commits(self, output: str, tasks: Set[str]) -> List[GitCommit]:
-        """Парсит и фильтрует коммиты, исключая merge."""
-        commits = []
-        for line in output.split('\n'):
-            if not line:
-                continue
-            parts = line.split('|', 5)
-            if len(parts) < 6:
-                continue
+        proc = self.run_stream(rev_list_cmd)
+        try:
+            for line in proc.stdout:
+                commit = self._parse_commit_line(line)
+                if commit is None:
+                    continue
+                # Игнорируем, если задачи из списка нет в теме (только в описании)
+                m = subject_re.search(commit.subject)
+                if m is None:
+                    continue
+                commit.task_id = m.group(1)
+                yield commit
+        finally:
+            proc.stdout.close()
+            proc.wait()
 
-            try:
-                h, subject, author, date, parents, ts = parts
-                task_id = self._extract_task_id(subject)
+    @staticmethod
+    def _tasks_pattern(tasks: Set[str]) -> str:
+        """
+        Собирает ERE-альтернацию (TASK1|TASK2|...) для git rev-list -E --grep,
+        совпадающую только с задачей целиком (ECOLOGY-10 не найдёт ECOLOGY-100).
+        """
+        # re.escape не подходит: он экранирует и '-', что для POSIX ERE не определено
+        escaped = (re.sub(r'([.\[\]()*+?{}|^$\\])', r'\\\1', t) for t in sorted(tasks))
+        # Границы слова через классы POSIX: \b — расширение GNU и есть не везде
+        return '(^|[^[:alnum:]_])(' + '|'.join(escaped) + ')([^[:alnum:]_]|$)'
+
+    @staticmethod
+    def _subject_tasks_re(tasks: Set[str]) -> re.Pattern:
+        """Регулярка для поиска задачи из списка в теме — с теми же границами слова, что и _tasks_pattern."""
+        return re.compile(
+            r'(?<![0-9A-Za-z_])(' + '|'.join(re.escape(t) for t in sorted(tasks)) + r')(?![0-9A-Za-z_])'
+        )
 
-                # Игнорируем, если задача не из списка
-                if not task_id or task_id not in tasks:
-                    continue
+    def _parse_commit_line(self, line: str) -> Optional[GitCommit]:
+        """Читает коммит по строке-хешу, исключая merge (task_id заполняет вызывающий код)."""
+        h = line.strip()
+        raw = self._read_object(h) if h else None
+        if raw is None:
+            return None
 
-                # Проверка merge по родителям (на всякий случай)
-                if len(parents.split()) > 1:
-                    continue
+        try:
+            h, subject, author, date, parents, ts = self._parse_raw_commit(h, raw)
+        except (ValueError, IndexError):
+            return None
+
+        # Проверка merge по родителям (на всякий случай)
+        if parents > 1:
+            return None
+
+        return GitCommit(
+            hash=h,
+            subject=subject,
+            author=author,
+            date=date,
+            timestamp=ts
+        )
 
-                commits.append(GitCommit(
-                    hash=h,
-                    subject=subject,
-                    author=author,
-                    date=date,
-                    timestamp=int(ts),
-                    task_id=task_id
-                ))
-            except (ValueError, IndexError):
-                continue
-
-        # ✅ СОРТИРУЕМ ТОЛЬКО ПО ВРЕМЕНИ (НЕ ПО ЗАДАЧАМ!)
-        commits.sort(key=lambda c: c.timestamp)
-        return commits
-
-    def _extract_task_id(self, subject: str) -> Optional[str]:
-        """Извлекает идентификатор задачи из темы коммита."""
-        # Исправлено: убраны экранированные скобки $$
-        patterns = [
-            r'([A-Z]+-\d+)',    # ECOLOGY-2994
-            r'$$([A-Z]+-\d+)$$', # [ECOLOGY-2994]
-            r'#(\d+)',          # #1234 (GitHub)
-        ]
-        for p in patterns:
-            m = re.search(p, subject)
-            if m:
-                return m.group(1)
-        return None
+    @staticmethod
+    def _parse_raw_commit(h: str, raw: bytes) -> Tuple[str, str, str, str, int, int]:
+        """Разбирает сырой объект коммита: (хеш, тема, автор, дата-iso, число родителей, timestamp)."""
+        header, _, message = raw.partition(b'\n\n')
+        parents = 0
+        ident = b''
+        encoding = 'utf-8'  # Без заголовка encoding git хранит сообщение в UTF-8
+        for line in header.split(b'\n'):
+            if line.startswith(b'parent '):
+                parents += 1
+            elif line.startswith(b'author '):
+                ident = line[len(b'author '):]
+            elif line.startswith(b'encoding '):
+                # Коммит сделан с i18n.commitEncoding: перекодируем, как это делает git log
+                encoding = line[len(b'encoding '):].decode('ascii', 'replace').strip()
+
+        def decode(data: bytes) -> str:
+            try:
+                return data.decode(encoding, 'replace')
+            except LookupError:  # Неизвестная Python кодировка
+                return data.decode('utf-8', 'replace')
+
+        # author Имя <email> 1700000000 +0300
+        name_email, ts, tz = ident.rsplit(b' ', 2)
+        author = decode(name_email.rpartition(b' <')[0])
+        timestamp = int(ts)
+        offset = (int(tz[1:3]) * 60 + int(tz[3:5])) * (-1 if tz[:1] == b'-' else 1)
+        moment = datetime.fromtimestamp(timestamp, timezone(timedelta(minutes=offset)))
+        # Тот же вид, что и `git log --date=iso`
+        date = f"{moment:%Y-%m-%d %H:%M:%S} {tz.decode()}"
+
+        # Тема — первый абзац сообщения в одну строку (как %s в git log)
+        paragraph = message.partition(b'\n\n')[0]
+        subject = ' '.join(l.strip() for l in decode(paragraph).splitlines())
+        return h, subject, author, date, parents, timestamp
+
+    def current_branch(self) -> str:
+        if self._current_branch is None:
+            self._current_branch = self.run(['git', 'branch', '--show-current'])
+        return self._current_branch
 
     def checkout(self, branch: str) -> None:
         self.run(['git', 'checkout', branch])
+        self._current_branch = branch
 
     def fetch(self):
         self.run(['git', 'fetch'])
@@ -118,6 +257,7 @@ class GitClient:
 
     def create_release_branch(self, release):
         self.run(['git', 'checkout', '-b', f"release/{release}"])
+        self._current_branch = f"release/{release}"
 
     def cherry_pick(self, hash: str) -> None:
         """Выполняет cherry-pick и выбрасывает исключение при конфликте."""
@@ -136,6 +276,38 @@ class GitClient:
                 stderr=result.stderr
             )
 
+    def unmerged_files(self) -> List[str]:
+        """Возвращает конфликтные файлы; git вызывается один раз до reset_unmerged_files()."""
+        if self._unmerged_files is None:
+            # -z: имена разделены NUL, без экранирования и с поддержкой любых символов
+            cmd = ['git', 'diff', '-z', '--name-only', '--diff-filter=U']
+            if self.verbose:
+                print(f" > {' '.join(cmd)}")
+            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            self._unmerged_files = [f for f in result.stdout.split('\0') if f]
+        return self._unmerged_files
+
+    def reset_unmerged_files(self) -> None:
+        self._unmerged_files = None
+
+    def pager(self, command: str) -> Optional[str]:
+        """
+        Возвращает pager, который git использовал бы для `git <command>`,
+        или None, если pager отключён.
+        """
+        if command not in self._pagers:
+            # pager.<command> может быть булевым значением или командой
+            value = self.run(['git', 'config', '--get', f'pager.{command}'], check=False)
+            if value.lower() in ('false', 'no', 'off', '0'):
+                pager = None
+            elif value and value.lower() not in ('true', 'yes', 'on', '1'):
+                pager = value
+            else:
+                # git var учитывает порядок git: GIT_PAGER, core.pager, PAGER, less
+                pager = self.run(['git', 'var', 'GIT_PAGER'], check=False) or 'less'
+            self._pagers[command] = None if pager == 'cat' else pager
+        return self._pagers[command]
+
     def cherry_pick_skip(self) -> None:
         self.run(['git', 'cherry-pick', '--skip'])
 
@@ -147,6 +319,8 @@ class CherryPicker:
     def __init__(self, git: GitClient, verbose: bool = False):
         self.git = git
         self.verbose = verbose
+        # Вывод git diff для текущего конфликта (сбрасывается _invalidate_conflict_cache)
+        self._cached_diff: Optional[bytes] = None
 
     def run(self, source: str, target: str, tasks: Set[str], release: str, dry_run: bool = False) -> None:
         print("=" * 70)
@@ -174,7 +348,7 @@ class CherryPicker:
             print("\nКоммиты для указанных задач не найдены.")
             return
 
-        # Показываем сводку (в хронологическом порядке!)
+        # Показываем сводку (в порядке применения!)
         self._show_commits(commits)
 
         if dry_run:
@@ -188,7 +362,7 @@ class CherryPicker:
             return
 
         # Применение
-        original = self.git.run(['git', 'branch', '--show-current'])
+        original = self.git.current_branch()
         try:
             if target != original:
                 self.git.checkout(target)
@@ -196,30 +370,29 @@ class CherryPicker:
             self.git.create_release_branch(release)
             self._apply_commits(commits)
         finally:
-            self.git.checkout(f"release/{release}")
-            # if original and original != self.git.run(['git', 'branch', '--show-current']):
+            # Ветка известна без вызова git: переключаемся, только если не на релизной
+            if self.git.current_branch() != f"release/{release}":
+                self.git.checkout(f"release/{release}")
+            # if original and original != self.git.current_branch():
             #     self.git.checkout(original)
 
     def _show_commits(self, commits: List[GitCommit]) -> None:
-        """Показывает коммиты в хронологическом порядке."""
+        """Показывает коммиты в порядке применения."""
         print(f"\nНайдено: {len(commits)} коммитов:")
         print("-" * 70)
-        for i, c in enumerate(commits, 1):
-            preview = c.subject[:60] + ("..." if len(c.subject) > 60 else "")
-            print(f"{i:3}. {c.hash[:8]} | {c.date} | {preview} ({c.task_id})")
+        # Один вызов write на весь список вместо print на каждую строку
+        lines = [
+            f"{i:3}. {c.hash[:8]} | {c.date} | {c.subject[:60]}{'...' if len(c.subject) > 60 else ''} ({c.task_id})"
+            for i, c in enumerate(commits, 1)
+        ]
+        sys.stdout.write('\n'.join(lines) + '\n')
 
     def _show_conflicts(self) -> None:
         """Показывает список конфликтных файлов и запускает git diff с цветом."""
         print("\nКонфликтные файлы:")
         try:
-            result = subprocess.run(
-                ['git', 'diff', '--name-only', '--diff-filter=U'],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            files = result.stdout.strip().split('\n')
-            if files and files[0]:
+            files = self.git.unmerged_files()
+            if files:
                 for i, f in enumerate(files, 1):
                     print(f"  {i}. {f}")
                 print("\nДля просмотра изменений используйте 'd' (diff) в меню действий.")
@@ -234,16 +407,39 @@ class CherryPicker:
         print("Для выхода нажмите 'q' (в less)")
         print("-" * 70)
         try:
-            # Запускаем git diff с цветом и pager'ом
-            subprocess.run(
-                ['git', 'diff', '--cached', '--color=always'],
-                check=True
-            )
+            # git diff считается один раз за конфликт, повторный 'd' показывает кеш
+            if self._cached_diff is None:
+                self._cached_diff = subprocess.run(
+                    ['git', 'diff', '--cached', '--color=always'],
+                    capture_output=True,
+                    check=True
+                ).stdout
+            self._page(self._cached_diff)
             print("-" * 70)
             print("Просмотр завершён.")
         except subprocess.CalledProcessError as e:
             print(f"Ошибка при выводе diff: {e}")
 
+    def _page(self, data: bytes) -> None:
+        """Показывает вывод diff через тот же pager, что выбрал бы git."""
+        sys.stdout.flush()
+        pager = self.git.pager('diff') if sys.stdout.isatty() else None
+        if pager:
+            env = dict(os.environ)
+            env.setdefault('LESS', 'FRX')  # Как у git: цвета (-R), выход, если всё влезло на экран
+            result = subprocess.run(pager, shell=True, input=data, env=env)
+            if result.returncode == 0:
+                return
+            print(f"⚠ Pager '{pager}' завершился с кодом {result.returncode}, выводим diff напрямую.")
+            sys.stdout.flush()
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    def _invalidate_conflict_cache(self) -> None:
+        """Сбрасывает кеши текущего конфликта после действий, меняющих состояние."""
+        self._cached_diff = None
+        self.git.reset_unmerged_files()
+
     def _handle_conflict(self, commit: GitCommit) -> Tuple[str, bool]:
         """
         Обрабатывает конфликт и возвращает (действие, успех).
@@ -253,6 +449,8 @@ class CherryPicker:
         print(f"Тема: {commit.subject}")
         print(f"{'=' * 70}\n")
 
+        # Список конфликтных файлов и diff запрашиваются у git один раз на конфликт
+        self._invalidate_conflict_cache()
         while True:
             self._show_conflicts()
             print("\nДоступные действия:")
@@ -297,41 +495,33 @@ class CherryPicker:
         """
         print(f"\nПрименяем стратегию: {strategy.upper()}")
         try:
-            result = subprocess.run(
-                ['git', 'diff', '--name-only', '--diff-filter=U'],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            files = result.stdout.strip().split('\n')
-            if files and files[0]:
+            files = self.git.unmerged_files()
+            if files:
+                # ✅ ВАЖНО: git checkout --theirs/ours работает только на unmerged файлах
+                # Все файлы одним вызовом; '--' отделяет пути от опций
+                subprocess.run(
+                    ['git', 'checkout', f'--{strategy}', '--'] + files,
+                    check=True
+                )
+                # Добавляем файлы в индекс, чтобы git понял, что конфликт решён
+                subprocess.run(['git', 'add', '--'] + files, check=True)
+                # Вызов либо применяется ко всем файлам, либо ни к одному — сообщаем после успеха
                 for f in files:
-                    if f and os.path.exists(f):
-                        print(f"  Устанавливаю '{strategy}' для: {f}")
-                        # ✅ ВАЖНО: git checkout --theirs/ours работает только на unmerged файлах
-                        subprocess.run(
-                            ['git', 'checkout', f'--{strategy}', f],
-                            check=True
-                        )
-                        # Добавляем файл в индекс, чтобы git понял, что конфликт решён
-                        subprocess.run(['git', 'add', f], check=True)
+                    print(f"  Установлено '{strategy}' для: {f}")
             else:
                 print("  Нет файлов для обработки. Вы уверены, что есть конфликт?")
         except subprocess.CalledProcessError as e:
             print(f"  Ошибка при применении стратегии: {e}")
             print("  Попробуйте разрешить конфликты вручную.")
+        finally:
+            # Набор конфликтных файлов и diff изменились
+            self._invalidate_conflict_cache()
 
     def _open_in_editor(self) -> None:
         """Открывает конфликты в редакторе (по умолчанию — vim)."""
         try:
-            result = subprocess.run(
-                ['git', 'diff', '--name-only', '--diff-filter=U'],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            files = result.stdout.strip().split('\n')
-            if files and files[0]:
+            files = self.git.unmerged_files()
+            if files:
                 editor = os.environ.get('EDITOR', 'vim')
                 print(f"\nОткрываем файлы в редакторе: {editor}")
                 subprocess.run([editor] + files, check=True)
@@ -344,6 +534,8 @@ class CherryPicker:
         """
         После разрешения конфликтов пробуем continue с --no-edit (чтобы не зависать).
         """
+        # Индекс мог измениться (ours/theirs/редактор), кеши конфликта устарели
+        self._invalidate_conflict_cache()
         try:
             print("  Выполняем 'git cherry-pick --continue --no-edit'...")
             # ✅ ВАЖНО: --no-edit предотвращает открытие редактора
@@ -364,6 +556,20 @@ class CherryPicker:
         """Применяет коммиты последовательно с полной обработкой конфликтов."""
         successful, skipped, failed = 0, 0, 0
 
+        # Проверяем все хеши заранее одним процессом, чтобы не тратить cherry-pick на отсутствующие
+        try:
+            existing = self.git.existing_commits([c.hash for c in commits])
+        except subprocess.CalledProcessError as e:
+            print(f"\n⚠ Не удалось проверить коммиты ({e.stderr.strip() or e}), применяем без проверки.")
+            existing = {c.hash for c in commits}
+        missing = [c for c in commits if c.hash not in existing]
+        if missing:
+            print(f"\nНе найдено в репозитории, пропускаем: {len(missing)}")
+            for c in missing:
+                print(f"  ✗ {c.hash[:8]} ({c.task_id})")
+            skipped += len(missing)
+            commits = [c for c in commits if c.hash in existing]
+
         for i, commit in enumerate(commits, 1):
             print(f"\n[{i}/{len(commits)}] Применение {commit.hash[:8]} ({commit.task_id})...")
             try:
@@ -403,10 +609,8 @@ def parse_tasks(args: List[str]) -> Set[str]:
     for arg in args:
         if os.path.isfile(arg):
             with open(arg, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        tasks.add(line)
+                text = f.read()
+            tasks.update(l for l in map(str.strip, text.splitlines()) if l and not l.startswith('#'))
         elif ',' in arg:
             tasks.update(t.strip() for t in arg.split(',') if t.strip())
         else:
@@ -448,7 +652,10 @@ def main():
 
     git = GitClient(verbose=args.verbose)
     picker = CherryPicker(git, verbose=args.verbose)
-    picker.run(args.source, args.target, tasks, dry_run=args.dry_run, release=args.release)
+    try:
+        picker.run(args.source, args.target, tasks, dry_run=args.dry_run, release=args.release)
+    finally:
+        git.close()
 
 
 if __name__ == "__main__":